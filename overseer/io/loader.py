@@ -1,4 +1,8 @@
+import multiprocessing
+import os
 import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
 
 import polars as pl
@@ -14,6 +18,20 @@ except Exception:  # pragma: no cover - handled at runtime if pandas not install
     pd = None
 
 
+# Column added to every row naming the CSV it came from, so checks can keep
+# row-to-row comparisons within one file.
+SOURCE_COLUMN = "__overseer_source_file"
+
+# zstd keeps staged files about half the size of the snappy default, and
+# row-group statistics let later scans prune row groups by min/max.
+_PARQUET_OPTIONS = dict(
+    compression="zstd",
+    compression_level=3,
+    row_group_size=100_000,
+    statistics=True,
+)
+
+
 def _read_csv_with_fallback(path: Path) -> pl.DataFrame:
     try:
         return pl.read_csv(path)
@@ -31,11 +49,27 @@ def _read_csv_with_fallback(path: Path) -> pl.DataFrame:
             sig = signature(pl.read_csv)
             filtered_kwargs = {k: v for k, v in csv_kwargs.items() if k in sig.parameters}
             return pl.read_csv(path, **filtered_kwargs)
+        except Exception:
+            pass
+
+        # Second fallback: polars' tolerant reader with every column read as a
+        # string, which copes with most ragged or oddly-typed files. Metric
+        # columns are cast back to numbers by `load_metrics`; the rest stay
+        # strings so codes/IDs keep leading zeros and full precision.
+        try:
+            return pl.read_csv(
+                path,
+                ignore_errors=True,
+                truncate_ragged_lines=True,
+                quote_char='"',
+                infer_schema_length=0,
+            )
         except Exception as e:
-            # If polars couldn't read even with filtered kwargs, try a tolerant
-            # pandas reader (engine='python') which can handle malformed quoting
-            # and then convert to a polars DataFrame. If pandas isn't available
-            # or also fails, raise a clear RuntimeError.
+            # Last resort: the pandas python-engine reader can handle
+            # malformed quoting but is far slower, so it is opt-in via
+            # OVERSEER_ALLOW_PANDAS=1.
+            if os.getenv("OVERSEER_ALLOW_PANDAS") != "1":
+                raise RuntimeError(f"Failed to read CSV {path}: {e}") from e
             if pd is None:
                 raise RuntimeError(
                     f"Failed to read CSV {path}: {e} (pandas not installed for fallback)"
@@ -62,108 +96,94 @@ def _read_csv_with_fallback(path: Path) -> pl.DataFrame:
                 raise RuntimeError(f"Failed to read CSV {path}: {e2}") from e2
 
 
-def load_metrics(metrics_dir: str, sample: int = None, max_files: int = None, skip_bad_files: bool = False):
-    """
-    Stream CSV files by reading them one-by-one, writing per-file Parquet to a
-    temporary directory, and returning a LazyFrame that scans those Parquet
-    files. This avoids materializing the entire dataset in memory.
+def _convert(f, out_path, row_limit=None) -> int:
+    """Convert one CSV to a Parquet file; return rows written.
 
-    - `sample`: optional int - stop after writing approx this many rows.
-    - `max_files`: optional int - process at most this many files.
-    - `skip_bad_files`: if True, continue past files that fail to parse.
+    Runs in a worker process. Raises RuntimeError if the file can't be read.
     """
+    try:
+        # Stream the CSV straight into Parquet without materializing it.
+        lf = pl.scan_csv(f, infer_schema_length=10000, ignore_errors=True)
+        if row_limit is not None:
+            lf = lf.slice(0, row_limit)
+        lf = lf.with_columns(pl.lit(str(f)).alias(SOURCE_COLUMN))
+        lf.sink_parquet(out_path, **_PARQUET_OPTIONS)
+    except Exception:
+        # The streaming reader couldn't handle this file; use the tolerant
+        # eager reader instead.
+        try:
+            df = _read_csv_with_fallback(f)
+        except RuntimeError:
+            # don't leave a partial file behind for the final scan to pick up
+            Path(out_path).unlink(missing_ok=True)
+            raise
+        if row_limit is not None and df.height > row_limit:
+            df = df.head(row_limit)
+        df = df.with_columns(pl.lit(str(f)).alias(SOURCE_COLUMN))
+        df.write_parquet(out_path, **_PARQUET_OPTIONS)
 
-    csvs = list(Path(metrics_dir).rglob("*.csv"))
-    if not csvs:
-        raise FileNotFoundError(f"No CSV files found in {metrics_dir}")
+    # Row count comes from the Parquet footer, no data is read.
+    return pl.scan_parquet(out_path).select(pl.len()).collect().item()
 
-    tmpdir = Path(metrics_dir) / ".stream_parquet"
-    # Fresh tmp dir
-    if tmpdir.exists():
-        shutil.rmtree(tmpdir)
-    tmpdir.mkdir(parents=True, exist_ok=True)
 
-    # First pass: determine canonical column set by reading headers only.
-    all_cols = []
-    seen = set()
-    for i, f in enumerate(csvs):
-        if max_files is not None and i >= max_files:
-            break
-        try:
-            hdr = pl.read_csv(f, n_rows=0)
-            cols = hdr.columns
-        except Exception:
-            # fallback to pandas for robust header parsing
-            if pd is None:
-                if skip_bad_files:
-                    continue
-                raise RuntimeError(f"Failed to read header for CSV {f}")
-            try:
-                cols = list(pd.read_csv(f, nrows=0, engine="python").columns)
-            except Exception:
-                if skip_bad_files:
-                    continue
-                raise RuntimeError(f"Failed to read header for CSV {f}")
-
-        for c in cols:
-            if c not in seen:
-                seen.add(c)
-                all_cols.append(c)
-
-    # Ensure canonical columns has at least the key metric
-    numeric_cols = {"total_count"}
-    for nc in numeric_cols:
-        if nc not in seen:
-            seen.add(nc)
-            all_cols.append(nc)
-
-    # Infer canonical types by sampling up to a few files and rows per file.
-    canonical_types = {}
-    sample_files = csvs[: min(len(csvs), 5) ]
-    sample_rows = 200
-    numeric_re = r'^[+-]?\d+(?:\.\d+)?$'
-    for col in all_cols:
-        numeric_votes = 0
-        non_null_votes = 0
-        for f in sample_files:
-            try:
-                # use pandas for robust sampling when available
-                if pd is not None:
-                    df_s = pd.read_csv(f, nrows=sample_rows, dtype=str, engine="python", on_bad_lines="skip")
-                    if col not in df_s.columns:
-                        continue
-                    ser = df_s[col].dropna().astype(str)
-                    if len(ser) == 0:
-                        continue
-                    non_null_votes += len(ser)
-                    numeric_votes += ser.str.match(numeric_re).sum()
-                else:
-                    # fallback to polars sampling
-                    df_s = pl.read_csv(f, n_rows=sample_rows)
-                    if col not in df_s.columns:
-                        continue
-                    ser = df_s.select(pl.col(col).cast(pl.Utf8)).to_series()
-                    ser = ser.drop_nulls()
-                    if len(ser) == 0:
-                        continue
-                    non_null_votes += len(ser)
-                    # use python regex on the numpy array
-                    import re
-                    numeric_votes += sum(1 for v in ser.to_list() if re.match(numeric_re, str(v)))
-            except Exception:
-                continue
-        if non_null_votes == 0:
-            canonical_types[col] = pl.Utf8
+def _try_convert(f, out_path, row_limit=None):
+    """`_convert` that reports read failures as `(0, message)` instead of raising."""
+    try:
+        return _convert(f, out_path, row_limit), None
+    except RuntimeError as e:
+        return 0, str(e)
+
+
+@contextmanager
+def _polars_threads(threads):
+    """Cap the polars thread pool of worker processes spawned in this block.
+
+    polars reads POLARS_MAX_THREADS when it is imported, which in a spawned
+    worker happens while re-importing the main module -- before any pool
+    initializer could run -- so the cap is exported from the parent and
+    inherited by the workers instead.
+    """
+    previous = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(threads)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("POLARS_MAX_THREADS", None)
         else:
-            if numeric_votes / non_null_votes >= 0.95:
-                canonical_types[col] = pl.Float64
-            else:
-                canonical_types[col] = pl.Utf8
+            os.environ["POLARS_MAX_THREADS"] = previous
 
+
+def _finalize(frame, total_rows, sample, metric_cols):
+    """Cast metric columns to Float64, ensure `total_count` exists and trim to `sample`.
+
+    A single stray non-numeric value makes polars infer a file's column as a
+    string, and the relaxed concat then widens it to a string for every file;
+    casting non-strictly turns such values into nulls instead.
+    """
+    if isinstance(frame, pl.LazyFrame):
+        names = frame.collect_schema().names()
+    else:
+        names = frame.columns
+    casts = [pl.col(c).cast(pl.Float64, strict=False).alias(c) for c in metric_cols if c in names]
+    # Ensure the result has at least the key metric
+    if "total_count" not in names:
+        casts.append(pl.lit(None, dtype=pl.Float64).alias("total_count"))
+    if casts:
+        frame = frame.with_columns(casts)
+    if sample is not None and total_rows > sample:
+        frame = frame.head(sample)
+    return frame
+
+
+def _load_in_memory(csvs, sample, max_files, skip_bad_files, metric_cols) -> pl.DataFrame:
+    """Read small datasets eagerly, skipping the Parquet staging roundtrip."""
+    frames = []
     total_rows = 0
-    files_written = 0
     for f in csvs:
-        if max_files is not None and files_written >= max_files:
+        if max_files is not None and len(frames) >= max_files:
+            break
+        if sample is not None and total_rows >= sample:
             break
         try:
             df = _read_csv_with_fallback(f)
@@ -173,54 +193,107 @@ def load_metrics(metrics_dir: str, sample: int = None, max_files: int = None, sk
             if skip_bad_files:
                 continue
             raise
-        # If sampling by rows is requested, truncate the last file to fit
-        if sample is not None:
-            remaining = sample - total_rows
-            if remaining <= 0:
-                break
-            if df.height > remaining:
-                df = df.head(remaining)
-
-        # Add missing canonical columns (with typed nulls) and cast existing columns
-        missing = [c for c in all_cols if c not in df.columns]
-        add_cols = []
-        for c in missing:
-            add_cols.append(pl.lit(None).cast(canonical_types.get(c, pl.Utf8)).alias(c))
-        if add_cols:
-            df = df.with_columns(add_cols)
-
-        # Cast existing columns to canonical types where possible
-        cast_cols = []
-        for c in all_cols:
-            if c in df.columns and c in canonical_types:
-                try:
-                    cast_cols.append(pl.col(c).cast(canonical_types[c]).alias(c))
-                except Exception:
-                    # ignore cast failures per-column
-                    pass
-        if cast_cols:
-            df = df.with_columns(cast_cols)
-
-        # Reorder to canonical column order
-        df = df.select([pl.col(c) for c in all_cols])
-
-        # write to parquet file in tmpdir
-        out_path = tmpdir / f"part-{files_written:06d}.parquet"
-        df.write_parquet(out_path)
-
+        frames.append(df.with_columns(pl.lit(str(f)).alias(SOURCE_COLUMN)))
         total_rows += df.height
-        files_written += 1
 
-        # Stop early if we've hit the sample limit
-        if sample is not None and total_rows >= sample:
-            break
+    if not frames:
+        return pl.DataFrame()
+    return _finalize(pl.concat(frames, how="diagonal_relaxed"), total_rows, sample, metric_cols)
+
+
+def load_metrics(metrics_dir: str, sample: int = None, max_files: int = None, skip_bad_files: bool = False,
+                 metric_cols=("total_count",)):
+    """
+    Stream CSV files into per-file Parquet (via `scan_csv` + `sink_parquet`)
+    in a temporary directory, and return a LazyFrame that diagonally
+    concatenates scans of those Parquet files. This avoids materializing the
+    entire dataset in memory.
+
+    Files may have different columns: the result has the union of all
+    columns, missing values are null, and conflicting dtypes are widened to a
+    common supertype (`how="diagonal_relaxed"`). Every row is tagged with
+    its CSV path in `SOURCE_COLUMN`.
+
+    If the CSVs total less than `OVERSEER_MEM_THRESHOLD` bytes (default
+    1 GiB), the Parquet staging is skipped and an eager DataFrame is returned.
+
+    - `sample`: optional int - stop after writing approx this many rows.
+    - `max_files`: optional int - process at most this many files.
+    - `skip_bad_files`: if True, continue past files that fail to parse.
+    - `metric_cols`: metric columns to cast to Float64 (non-numeric values become null).
+    """
+
+    csvs = list(Path(metrics_dir).rglob("*.csv"))
+    if not csvs:
+        raise FileNotFoundError(f"No CSV files found in {metrics_dir}")
+
+    considered = csvs if max_files is None else csvs[:max_files]
+    total_bytes = sum(f.stat().st_size for f in considered)
+    if total_bytes < int(os.getenv("OVERSEER_MEM_THRESHOLD", 1 << 30)):
+        return _load_in_memory(csvs, sample, max_files, skip_bad_files, metric_cols)
+
+    tmpdir = Path(metrics_dir) / ".stream_parquet"
+    # Fresh tmp dir
+    if tmpdir.exists():
+        shutil.rmtree(tmpdir)
+    tmpdir.mkdir(parents=True, exist_ok=True)
+
+    # Convert files in parallel. Use "spawn" because polars is not fork-safe.
+    workers = max(1, int(os.getenv("OVERSEER_LOAD_WORKERS", os.cpu_count() or 1)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    total_rows = 0
+    done = []  # (csv index, parquet path)
+
+    def _record(idx, f, out_path, rows, error):
+        nonlocal total_rows
+        if error is not None:
+            msg = f"Warning: could not read {f}. Error: {error}"
+            print(msg, file=sys.stderr)
+            if not skip_bad_files:
+                raise RuntimeError(error)
+            return
+        total_rows += rows
+        done.append((idx, out_path))
+
+    with _polars_threads(threads), ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        if sample is None and max_files is None:
+            # Nothing can stop the run early: hand every file to the pool.
+            out_paths = [tmpdir / f"part-{idx:06d}.parquet" for idx in range(len(csvs))]
+            results = executor.map(_try_convert, csvs, out_paths)
+            for idx, (f, out_path, (rows, error)) in enumerate(zip(csvs, out_paths, results)):
+                _record(idx, f, out_path, rows, error)
+        else:
+            # Refill the pool as files finish so one large file doesn't idle
+            # the other workers, and stop submitting once a limit is reached.
+            pending = list(enumerate(csvs))
+            in_flight = {}
+            while pending or in_flight:
+                while pending and len(in_flight) < workers:
+                    if max_files is not None and len(done) + len(in_flight) >= max_files:
+                        break
+                    if sample is not None and total_rows >= sample:
+                        break
+                    idx, f = pending.pop(0)
+                    out_path = tmpdir / f"part-{idx:06d}.parquet"
+                    # Each file may use the whole remaining row budget; the
+                    # combined result is trimmed to `sample` below.
+                    row_limit = None if sample is None else sample - total_rows
+                    in_flight[executor.submit(_try_convert, f, out_path, row_limit)] = (idx, f, out_path)
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    idx, f, out_path = in_flight.pop(fut)
+                    _record(idx, f, out_path, *fut.result())
 
-    if files_written == 0:
+    parts = [out_path for _, out_path in sorted(done)]
+    if not parts:
         return pl.DataFrame()
 
     # Return a LazyFrame scanning the parquet files so downstream processing
     # (e.g. detect_drops) can be executed lazily and will only materialize
     # a small result set.
-    pattern = str(tmpdir / "*.parquet")
-    lf = pl.scan_parquet(pattern)
-    return lf
+    lf = pl.concat([pl.scan_parquet(p) for p in parts], how="diagonal_relaxed")
+    return _finalize(lf, total_rows, sample, metric_cols)
@@ -1,8 +1,222 @@
+import asyncio
+import atexit
+import json
 import os
 import sys
+import tempfile
+import threading
+import time
 import traceback
+from collections import deque
+from pathlib import Path
+
+try:
+    import orjson  # optional dependency: faster JSON for the REST fallback
+except Exception:  # pragma: no cover - handled at runtime if orjson not installed
+    orjson = None
+
+
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def _json_loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 MODEL_ENV = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+MAX_OUTPUT_TOKENS = int(os.getenv("OVERSEER_LLM_MAX_TOKENS", "256"))
+LLM_TIMEOUT = float(os.getenv("OVERSEER_LLM_TIMEOUT", "20"))
+LLM_RETRIES = int(os.getenv("OVERSEER_LLM_RETRIES", "3"))
+BATCH_POLL_SECONDS = float(os.getenv("OVERSEER_BATCH_POLL", "30"))
+
+
+class RateLimiter:
+    """Client-side requests/tokens-per-minute budget over a rolling window.
+
+    `acquire` waits until sending one more request of `est_tokens` would stay
+    within both limits. A limit of 0 disables that dimension. The window is
+    shared across event loops; the lock is recreated for each loop since an
+    `asyncio.Lock` can only be used from the loop it first binds to.
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._lock = None
+        self._lock_loop = None
+        self._events = deque()  # (timestamp, tokens)
+
+    async def acquire(self, est_tokens: int) -> None:
+        if not self.rpm and not self.tpm:
+            return
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        # Holding the lock while sleeping keeps waiters in FIFO order.
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._events and self._events[0][0] <= now - self.window:
+                    self._events.popleft()
+                over_rpm = self.rpm and len(self._events) >= self.rpm
+                over_tpm = (
+                    self.tpm
+                    and self._events
+                    and sum(t for _, t in self._events) + est_tokens > self.tpm
+                )
+                if not (over_rpm or over_tpm):
+                    break
+                await asyncio.sleep(max(0.0, self._events[0][0] + self.window - now))
+            self._events.append((time.monotonic(), est_tokens))
+
+
+_limiter = RateLimiter(
+    rpm=int(os.getenv("OVERSEER_RPM", "0")),
+    tpm=int(os.getenv("OVERSEER_TPM", "0")),
+)
+
+
+# Explanations memoized by (metric_name, change rounded to 0.1%, context,
+# model, max output tokens) so near-identical anomalies share one LLM call.
+# Persisted between runs as JSON (a list of [key, explanation] pairs) and
+# loaded on first use, so importing this module never reads the file.
+CACHE_PATH = Path(os.getenv("OVERSEER_LLM_CACHE", "reports/.llm_cache.json"))
+_explain_cache: dict = {}
+_explain_cache_lock = threading.Lock()
+_explain_cache_dirty = False
+_explain_cache_loaded = False
+
+
+def _ensure_cache_loaded():
+    """Load the persisted cache once; caller must hold `_explain_cache_lock`."""
+    global _explain_cache_loaded
+    if _explain_cache_loaded:
+        return
+    _explain_cache_loaded = True
+    try:
+        with open(CACHE_PATH, "r", encoding="utf-8") as fh:
+            entries = json.load(fh)
+        for key, explanation in entries:
+            if isinstance(explanation, str):
+                _explain_cache.setdefault(tuple(key), explanation)
+    except Exception:
+        # missing or unreadable cache just means starting cold
+        pass
+
+
+def _save_cache():
+    with _explain_cache_lock:
+        if not _explain_cache_dirty:
+            return
+        snapshot = [[list(k), v] for k, v in _explain_cache.items()]
+    try:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(CACHE_PATH, "w", encoding="utf-8") as fh:
+            json.dump(snapshot, fh)
+    except Exception as e:
+        print(f"Warning: could not save LLM cache to {CACHE_PATH}: {e}", file=sys.stderr)
+
+
+atexit.register(_save_cache)
+
+
+def _cache_key(metric_name, change, context):
+    model = os.getenv("OPENAI_MODEL", MODEL_ENV)
+    return (metric_name, round(change, 3), context, model, MAX_OUTPUT_TOKENS)
+
+
+def _cache_get(key):
+    with _explain_cache_lock:
+        _ensure_cache_loaded()
+        return _explain_cache.get(key)
+
+
+def _remember(key, explanation):
+    """Store a successful explanation in the cache and return it."""
+    global _explain_cache_dirty
+    with _explain_cache_lock:
+        _ensure_cache_loaded()
+        _explain_cache[key] = explanation
+        _explain_cache_dirty = True
+    return explanation
+
+
+def _build_prompt(metric_name, change, context):
+    return f"The metric '{metric_name}' changed by {change:.2%}. Context: {context}. Explain why this might happen."
+
+
+def _clean_explanation(text: str) -> str:
+    """Normalize whitespace and ensure the string ends with terminal punctuation.
+
+    This helps prevent truncated/incomplete sentences appearing in reports.
+    """
+    if not text:
+        return "LLM returned an empty explanation."
+    # Normalize whitespace
+    s = " ".join(str(text).split())
+    # If the text ends with an opening parenthesis or similar, close it gracefully
+    s = s.strip()
+    # Ensure sentence ends with proper punctuation
+    if s and s[-1] not in ".!?":
+        s = s + "."
+    return s
+
+
+def _explanation_from_response(resp):
+    """Extract the explanation text from an OpenAI client chat completion.
+
+    Returns None if the response doesn't have the expected shape.
+    """
+    if hasattr(resp, "choices") and resp.choices:
+        choice = resp.choices[0]
+        if hasattr(choice, "message") and getattr(choice.message, "content", None):
+            return _clean_explanation(choice.message.content)
+        if hasattr(choice, "text"):
+            return _clean_explanation(choice.text)
+    return None
+
+
+HTTP_POOL_SIZE = 32
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """Return a shared `requests.Session` for the REST fallback.
+
+    Reusing one pooled session avoids a TLS handshake per call; transient
+    errors and 429s are retried with backoff.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=LLM_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(["POST"]),
+                raise_on_status=False,
+            )
+            session = requests.Session()
+            session.mount(
+                "https://",
+                HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry),
+            )
+            _session = session
+        return _session
+
+
 def explain_anomaly(metric_name, change, context):
     """Return an explanation string for an anomaly.
 
@@ -11,28 +225,19 @@ def explain_anomaly(metric_name, change, context):
     - On client-init failure try a direct HTTP POST to OpenAI's REST API
       using `requests` (this avoids httpx/httpcore compatibility issues).
     - If neither path is available, return a clear fallback string.
+
+    Successful explanations are cached (see `_cache_key`) and reused.
     """
+    key = _cache_key(metric_name, change, context)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         return "LLM explanation skipped (no OPENAI_API_KEY)."
 
-    prompt = f"The metric '{metric_name}' changed by {change:.2%}. Context: {context}. Explain why this might happen."
-
-    def _clean_explanation(text: str) -> str:
-        """Normalize whitespace and ensure the string ends with terminal punctuation.
-
-        This helps prevent truncated/incomplete sentences appearing in reports.
-        """
-        if not text:
-            return "LLM returned an empty explanation."
-        # Normalize whitespace
-        s = " ".join(str(text).split())
-        # If the text ends with an opening parenthesis or similar, close it gracefully
-        s = s.strip()
-        # Ensure sentence ends with proper punctuation
-        if s and s[-1] not in ".!?":
-            s = s + "."
-        return s
+    prompt = _build_prompt(metric_name, change, context)
 
     # Use a module-level memoized backend detection to avoid noisy repeated
     # tracebacks when many anomalies are processed.
@@ -50,7 +255,7 @@ def explain_anomaly(metric_name, change, context):
         try:
             from openai import OpenAI as _OpenAI
             try:
-                _llm_client = _OpenAI(api_key=api_key)
+                _llm_client = _OpenAI(api_key=api_key, timeout=LLM_TIMEOUT, max_retries=LLM_RETRIES)
                 _llm_backend = "client"
             except Exception as e:
                 # capture initialization error but don't spam
@@ -79,14 +284,12 @@ def explain_anomaly(metric_name, change, context):
             resp = _llm_client.chat.completions.create(
                 model=os.getenv("OPENAI_MODEL", MODEL_ENV),
                 messages=[{"role": "user", "content": prompt}],
+                max_tokens=MAX_OUTPUT_TOKENS,
             )
-            if hasattr(resp, "choices") and resp.choices:
-                choice = resp.choices[0]
-                if hasattr(choice, "message") and getattr(choice.message, "content", None):
-                    return _clean_explanation(choice.message.content)
-                if hasattr(choice, "text"):
-                    return _clean_explanation(choice.text)
-            return "LLM explanation returned an unexpected response shape."
+            text = _explanation_from_response(resp)
+            if text is None:
+                return "LLM explanation returned an unexpected response shape."
+            return _remember(key, text)
         except Exception as e:
             # if client fails on first use, record error and fall back to requests
             traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
@@ -94,7 +297,7 @@ def explain_anomaly(metric_name, change, context):
 
     if _llm_backend == "requests" or _llm_backend is None:
         try:
-            import requests
+            session = _get_session()
         except Exception:
             return "LLM explanation unavailable (no compatible OpenAI client and `requests` not installed)."
 
@@ -106,25 +309,268 @@ def explain_anomaly(metric_name, change, context):
         payload = {
             "model": os.getenv("OPENAI_MODEL", MODEL_ENV),
             "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 256,
+            "max_tokens": MAX_OUTPUT_TOKENS,
         }
         try:
-            r = requests.post(url, headers=headers, json=payload, timeout=30)
+            r = session.post(url, headers=headers, data=_json_dumps(payload), timeout=LLM_TIMEOUT)
         except Exception as e:
             traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
             return f"LLM explanation unavailable (network/request failed: {type(e).__name__})."
 
         if r.status_code != 200:
             try:
-                body = r.json()
+                body = _json_loads(r.content)
             except Exception:
                 body = r.text
             return f"LLM explanation failed (HTTP {r.status_code}: {body})."
 
-        data = r.json()
         try:
-            return _clean_explanation(data["choices"][0]["message"]["content"])
+            data = _json_loads(r.content)
+            text = _clean_explanation(data["choices"][0]["message"]["content"])
         except Exception:
             return "LLM explanation returned an unexpected REST response shape."
+        return _remember(key, text)
 
     return "LLM explanation unavailable (no viable backend)."
+
+
+_llm_async_client = None
+_llm_async_client_loop = None
+_llm_async_init_failed = False
+_llm_async_error_logged = False
+
+
+def _get_async_client(api_key):
+    """Return an `openai.AsyncOpenAI` client for the running loop, or None if unavailable.
+
+    The client's connection pool belongs to the loop it was created on, so a
+    new client is built whenever the loop changes.
+    """
+    global _llm_async_client, _llm_async_client_loop, _llm_async_init_failed
+    loop = asyncio.get_running_loop()
+    if _llm_async_client_loop is not loop:
+        _llm_async_client = None
+    if _llm_async_client is None and not _llm_async_init_failed:
+        try:
+            import httpx
+            from openai import AsyncOpenAI as _AsyncOpenAI
+            _llm_async_client = _AsyncOpenAI(
+                api_key=api_key,
+                timeout=LLM_TIMEOUT,
+                max_retries=LLM_RETRIES,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+                ),
+            )
+            _llm_async_client_loop = loop
+        except Exception:
+            # the sync path logs its own init errors; just remember not to retry
+            _llm_async_init_failed = True
+    return _llm_async_client
+
+
+async def _close_async_client():
+    """Close the async client created on the running loop, if any."""
+    global _llm_async_client, _llm_async_client_loop
+    client = _llm_async_client
+    if client is None or _llm_async_client_loop is not asyncio.get_running_loop():
+        return
+    _llm_async_client = None
+    _llm_async_client_loop = None
+    try:
+        await client.close()
+    except Exception:
+        pass
+
+
+async def explain_anomaly_async(metric_name, change, context):
+    """Async counterpart of `explain_anomaly`.
+
+    Uses `openai.AsyncOpenAI` so many explanations can be in flight at once.
+    If the async client can't be constructed, the sync implementation (and
+    its `requests` fallback) is run in a worker thread instead. Request
+    failures are not retried beyond the client's own `max_retries`; the first
+    one is logged and a fallback string is returned.
+    """
+    global _llm_async_error_logged
+    key = _cache_key(metric_name, change, context)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return "LLM explanation skipped (no OPENAI_API_KEY)."
+
+    prompt = _build_prompt(metric_name, change, context)
+    await _limiter.acquire(len(prompt) // 4 + MAX_OUTPUT_TOKENS)
+
+    client = _get_async_client(api_key)
+    if client is None:
+        return await asyncio.to_thread(explain_anomaly, metric_name, change, context)
+
+    try:
+        resp = await client.chat.completions.create(
+            model=os.getenv("OPENAI_MODEL", MODEL_ENV),
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=MAX_OUTPUT_TOKENS,
+        )
+    except Exception as e:
+        # Log only once so a rate-limit or outage doesn't print a traceback
+        # per anomaly.
+        if not _llm_async_error_logged:
+            _llm_async_error_logged = True
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+        return f"LLM explanation unavailable (request failed: {type(e).__name__})."
+    text = _explanation_from_response(resp)
+    if text is None:
+        return "LLM explanation returned an unexpected response shape."
+    return _remember(key, text)
+
+
+async def explain_anomalies_async(items, concurrency):
+    """Explain a list of `(metric_name, change, context)` items concurrently.
+
+    Items that share a cache key are coalesced so each unique prompt is sent
+    once, with at most `concurrency` requests in flight. Returns explanations
+    in the same order as `items`.
+    """
+    unique = {}
+    for m, c, ctx in items:
+        unique.setdefault(_cache_key(m, c, ctx), (m, c, ctx))
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def _explain_one(metric_name, change, context):
+        async with sem:
+            return await explain_anomaly_async(metric_name, change, context)
+
+    try:
+        answers = await asyncio.gather(*(_explain_one(*item) for item in unique.values()))
+    finally:
+        await _close_async_client()
+    by_key = dict(zip(unique, answers))
+    return [by_key[_cache_key(m, c, ctx)] for m, c, ctx in items]
+
+
+def _batch_error_summary(client, batch) -> str:
+    """Describe why a batch produced no output, using its error file if any."""
+    if not batch.error_file_id:
+        return "no error file was produced"
+    try:
+        lines = [ln for ln in client.files.content(batch.error_file_id).text.splitlines() if ln.strip()]
+        first = json.loads(lines[0])
+        error = (first.get("response") or {}).get("body", {}).get("error") or first.get("error") or {}
+        message = error.get("message") if isinstance(error, dict) else str(error)
+        return f"{len(lines)} errors, first: {message}"
+    except Exception as e:
+        return f"could not read error file {batch.error_file_id} ({e})"
+
+
+def submit_batch(prompts):
+    """Explain many prompts through the OpenAI Batch API.
+
+    `prompts` is a list of `(key, prompt)` tuples. The prompts are uploaded as
+    one JSONL file, the batch is polled until it finishes (this can take up to
+    the 24h completion window), and a dict mapping each key to its explanation
+    is returned. Keys whose request failed are left out (and reported on
+    stderr). Raises RuntimeError if the batch can't be submitted or does not
+    complete.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    try:
+        from openai import OpenAI as _OpenAI
+        client = _OpenAI(api_key=api_key, timeout=LLM_TIMEOUT, max_retries=LLM_RETRIES)
+    except Exception as e:
+        raise RuntimeError(f"OpenAI client unavailable for batch mode: {e}") from e
+
+    keys = {}
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as fh:
+        batch_path = Path(fh.name)
+        for i, (key, prompt) in enumerate(prompts):
+            custom_id = f"req-{i}"
+            keys[custom_id] = key
+            fh.write(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": os.getenv("OPENAI_MODEL", MODEL_ENV),
+                    "messages": [{"role": "user", "content": prompt}],
+                    "max_tokens": MAX_OUTPUT_TOKENS,
+                },
+            }) + "\n")
+
+    try:
+        with open(batch_path, "rb") as fh:
+            input_file = client.files.create(file=fh, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        try:
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                time.sleep(BATCH_POLL_SECONDS)
+                batch = client.batches.retrieve(batch.id)
+        except KeyboardInterrupt:
+            # don't leave a billed batch running after the user gives up
+            try:
+                client.batches.cancel(batch.id)
+                print(f"Cancelled LLM batch {batch.id}.", file=sys.stderr)
+            except Exception as e:
+                print(f"Warning: could not cancel LLM batch {batch.id}: {e}", file=sys.stderr)
+            raise
+        if batch.status != "completed":
+            raise RuntimeError(f"LLM batch {batch.id} ended with status '{batch.status}'")
+        if not batch.output_file_id:
+            raise RuntimeError(
+                f"LLM batch {batch.id} completed but every request failed: {_batch_error_summary(client, batch)}"
+            )
+        output = client.files.content(batch.output_file_id).text
+    finally:
+        batch_path.unlink(missing_ok=True)
+
+    explanations = {}
+    failed = 0
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        key = keys.get(item.get("custom_id"))
+        if key is None:
+            continue
+        response = item.get("response") or {}
+        try:
+            if response.get("status_code") != 200:
+                raise ValueError(item.get("error") or response.get("status_code"))
+            explanations[key] = _clean_explanation(response["body"]["choices"][0]["message"]["content"])
+        except Exception:
+            failed += 1
+    if failed:
+        print(f"Warning: {failed} LLM batch requests failed.", file=sys.stderr)
+    return explanations
+
+
+def explain_anomalies_batch(items):
+    """Batch counterpart of `explain_anomaly` for a list of `(metric_name, change, context)`.
+
+    Cached explanations are reused; only the remaining unique prompts are sent
+    via `submit_batch`. Returns explanations in the same order as `items`.
+    """
+    keys = [_cache_key(m, c, ctx) for m, c, ctx in items]
+    pending = {}
+    for key, (m, c, ctx) in zip(keys, items):
+        if key not in pending and _cache_get(key) is None:
+            pending[key] = _build_prompt(m, c, ctx)
+
+    if pending:
+        for key, text in submit_batch(list(pending.items())).items():
+            _remember(key, text)
+
+    return [
+        _cache_get(key) or "LLM explanation unavailable (batch request failed)."
+        for key in keys
+    ]
@@ -1,9 +1,38 @@
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from pathlib import Path
 
+_template = None
+
+
+def _get_template():
+    """Parse and compile the template once per process.
+
+    Built lazily so importing this module (e.g. in spawned loader workers)
+    does no filesystem work. The bytecode cache lets later runs skip
+    compiling the template again; with no directory argument Jinja uses a
+    private per-user cache dir (mode 0700, ownership checked), and rendering
+    proceeds without it if that dir can't be created or verified.
+    """
+    global _template
+    if _template is None:
+        try:
+            bytecode_cache = FileSystemBytecodeCache()
+        except (RuntimeError, OSError):
+            # the cache is only a speed-up; never let it fail the report
+            bytecode_cache = None
+        env = Environment(
+            loader=FileSystemLoader(Path(__file__).parent / "templates"),
+            auto_reload=False,
+            cache_size=50,
+            bytecode_cache=bytecode_cache,
+        )
+        _template = env.get_template("report.html")
+    return _template
+
+
 def build_report(results, output_file="report.html"):
-    env = Environment(loader=FileSystemLoader("overseer/reporting/templates"))
-    template = env.get_template("report.html")
-    html = template.render(results=results)
-    Path(output_file).write_text(html, encoding="utf-8")
+    # Stream rendered chunks straight to disk instead of building the whole
+    # document in memory first.
+    with open(output_file, "wb") as fh:
+        _get_template().stream(results=results).dump(fh, encoding="utf-8")
     print(f"Report saved to {output_file}")
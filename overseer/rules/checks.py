@@ -1,15 +1,22 @@
 import polars as pl
 
 
-def detect_drops(df, col="total_count", threshold=0.05):
-    # Support both eager DataFrame and LazyFrame inputs.
-    if isinstance(df, pl.LazyFrame):
-        lf = df.with_columns(((pl.col(col).diff()) / pl.col(col).shift(1)).alias("change_rate"))
-        res = lf.filter(pl.col("change_rate") < -threshold).collect()
-        return res
-
-    # eager DataFrame
-    if col not in df.columns:
+def detect_drops(df, col="total_count", threshold=0.05, partition_by=None):
+    # Support both eager DataFrame and LazyFrame inputs by running a single
+    # lazy query; `partition_by` restricts diff/shift to rows of the same group
+    # so change rates aren't computed across unrelated series.
+    lf = df.lazy() if isinstance(df, pl.DataFrame) else df
+    if col not in lf.collect_schema().names():
         raise ValueError(f"Column {col} not found in dataframe.")
-    df = df.with_columns((df[col].diff() / df[col].shift(1)).alias("change_rate"))
-    return df.filter(df["change_rate"] < -threshold)
+
+    change_rate = pl.col(col).diff() / pl.col(col).shift(1)
+    if partition_by:
+        change_rate = change_rate.over(partition_by)
+
+    return (
+        lf.with_columns(change_rate.alias("change_rate"))
+        .filter(pl.col("change_rate") < -threshold)
+        # most severe drops first
+        .sort("change_rate")
+        .collect(streaming=True)
+    )